@@ -1,61 +1,216 @@
 import os
-import json
 import io
+import hashlib
+import threading
+import time
 import streamlit as st
-import pandas as pd
+import polars as pl
+import orjson
+import xlsxwriter
 
+from collections import OrderedDict
 from openai import OpenAI
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 MODEL = "gpt-4o-mini"
+MAX_TOKENS_PER_AC = 1000  # output budget per criterion; baseline value, not yet measured against real replies
+TRUNCATED_ERROR = "The response hit the token limit before the JSON was complete. Please try again, or simplify the acceptance criteria."
+RESPONSE_CACHE_SIZE = 128  # completions kept across sessions
+RESPONSE_CACHE_TTL = 3600  # seconds each cached completion stays valid
 
 def get_api_key():
     return st.session_state.get("openai_api_key") or OPENAI_API_KEY
 
-def call_openai(prompt: str, model: str = MODEL):
+@st.cache_resource(show_spinner=False)
+def get_client(api_key: str) -> OpenAI:
+    # One client (and connection pool) per key, reused across reruns
+    return OpenAI(api_key=api_key)
+
+class ResponseCache:
+    # LRU map of (api key, model, prompt) hash -> raw completion, each entry expiring after ttl seconds
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            if key not in self._items:
+                return None
+            stored_at, text = self._items[key]
+            if time.monotonic() - stored_at > self.ttl:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return text
+
+    def put(self, key: str, text: str):
+        with self._lock:
+            self._items[key] = (time.monotonic(), text)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache() -> ResponseCache:
+    return ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+def response_key(prompt: str, model: str, api_key: str) -> str:
+    # The API key is part of the hash so one session never reuses completions paid for by another key
+    return hashlib.blake2b(f"{api_key}\0{model}\0{prompt}".encode(), digest_size=16).hexdigest()
+
+def call_openai(prompt: str, model: str = MODEL, max_tokens: int = MAX_TOKENS_PER_AC):
     api_key = get_api_key()
     if not api_key:
         raise ValueError("API key not set.")
 
-    client = OpenAI(api_key=api_key)
+    client = get_client(api_key)
     
-    resp = client.chat.completions.create(
+    stream = client.chat.completions.create(
         model=model,
         messages=[
             {"role": "system", "content": "You are a QA engineer who outputs JSON only."},
             {"role": "user", "content": prompt},
         ],
-        max_tokens=1000,
+        max_tokens=max_tokens,
         temperature=0.0,
+        response_format={"type": "json_object"},
+        stream=True,
     )
-    return resp.choices[0].message.content
+
+    # Show progress while tokens arrive; JSON is only parsed once the stream ends
+    progress = st.empty()
+    parts = []
+    received = 0
+    finish_reason = None
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        if chunk.choices[0].delta.content:
+            parts.append(chunk.choices[0].delta.content)
+            received += len(parts[-1])
+            progress.markdown(f"✍️ Generating… {received} characters received")
+        finish_reason = chunk.choices[0].finish_reason or finish_reason
+    progress.empty()
+
+    if finish_reason == "length":
+        raise ValueError(TRUNCATED_ERROR)
+
+    return "".join(parts)
 
 def extract_json(text: str):
+    # response_format=json_object makes the API return a single JSON object;
+    # a ```json fence is still stripped in case a model wraps it anyway
+    t = text.strip()
+    if t.startswith("```"):
+        t = t.split("```", 2)[1].removeprefix("json").strip()
     try:
-        return json.loads(text)
-    except:
-        import re
-        m = re.search(r'(\{.*\})', text, re.S)
-        if m:
-            try:
-                return json.loads(m.group(1))
-            except:
-                pass
-    return {"raw_text": text}
+        return orjson.loads(t)
+    except orjson.JSONDecodeError:
+        return {"raw_text": text}
 
 PROMPT = """
-I will provide acceptance criteria. Produce JSON:
+I will provide an indexed list of acceptance criteria. Produce JSON:
 {{
- "positive": [...],
- "negative": [...]
+ "results": [
+  {{"index": i, "positive": [...], "negative": [...]}}
+ ]
 }}
-Each test has: id, title, preconditions, steps, expected_result, priority.
-Generate 3-6 positive and 3-6 negative tests. JSON only.
+Return one entry per index. Each test has: id, title, preconditions, steps, expected_result, priority.
+Generate 3-6 positive and 3-6 negative tests per entry. JSON only.
 
-Acceptance Criteria:
-{ac}
+Acceptance Criteria list (indexed):
+{ac_list}
 """
 
+def batch_prompt(acs: list[str]) -> str:
+    ac_list = "\n\n".join(f"[{i}]\n{ac}" for i, ac in enumerate(acs))
+    return PROMPT.format(ac_list=ac_list)
+
+def split_results(raw: str, count: int):
+    parsed = extract_json(raw)
+
+    if not isinstance(parsed, dict):
+        return [{} for _ in range(count)]
+    if "results" not in parsed and count == 1:
+        # Model answered a single criterion without the wrapper
+        return [parsed]
+
+    items = parsed.get("results")
+    items = [item for item in items if isinstance(item, dict)] if isinstance(items, list) else []
+    if count == 1 and len(items) == 1:
+        # Only one possible match, whatever index the model gave it
+        return items
+
+    by_index = {}
+    for item in items:
+        try:
+            by_index[int(item.get("index"))] = item
+        except (TypeError, ValueError):
+            continue
+    return [by_index.get(i, {}) for i in range(count)]
+
+def call_openai_batch(acs: list[str], model: str = MODEL):
+    # One round trip for all criteria; results are matched back by index
+    prompt = batch_prompt(acs)
+    cache = get_response_cache()
+    key = response_key(prompt, model, get_api_key())
+
+    raw = cache.get(key)
+    if raw is None:
+        raw = call_openai(prompt, model, max_tokens=MAX_TOKENS_PER_AC * len(acs))
+    results = split_results(raw, len(acs))
+
+    # Only cache replies that produced tests, so "try again" really calls the API again
+    if all("positive" in r or "negative" in r for r in results):
+        cache.put(key, raw)
+    return results, raw
+
+# Model output keys -> display columns
+FIELD_COLUMNS = {
+    "id": "ID",
+    "title": "Title",
+    "preconditions": "Preconditions",
+    "steps": "Steps",
+    "expected_result": "Expected Result",
+    "priority": "Priority",
+}
+
+def cell_text(value):
+    # Model fields may be strings, numbers, lists (steps, preconditions...) or objects
+    if value is None:
+        return None
+    if isinstance(value, list):
+        return "\n".join(t for t in map(cell_text, value) if t is not None)
+    return value if isinstance(value, str) else str(value)
+
+TEST_TYPES = ["Positive", "Negative"]
+PRIORITIES = ["High", "Medium", "Low"]
+
+@st.cache_data(show_spinner=False)
+def build_csv(df: pl.DataFrame) -> bytes:
+    return df.write_csv().encode("utf-8")
+
+@st.cache_data(show_spinner=False)
+def build_xlsx(df: pl.DataFrame) -> bytes:
+    # constant_memory flushes each row once the next one starts, so widths are set up front
+    # and rows are written in order
+    excel_buf = io.BytesIO()
+    workbook = xlsxwriter.Workbook(excel_buf, {"constant_memory": True})
+    worksheet = workbook.add_worksheet("TestCases")
+
+    # Auto-adjust columns width: longest cell (or header) per column, measured column-wise
+    cell_lens = df.select(pl.all().cast(pl.String).str.len_chars().max().fill_null(0)).row(0)
+    for i, (col, cell_len) in enumerate(zip(df.columns, cell_lens)):
+        worksheet.set_column(i, i, max(cell_len, len(col)) + 2)
+
+    worksheet.write_row(0, 0, df.columns, workbook.add_format({"bold": True, "border": 1}))
+    for row_idx, row in enumerate(df.iter_rows(), start=1):
+        worksheet.write_row(row_idx, 0, row)
+    workbook.close()
+    return excel_buf.getvalue()
+
 # Set page config at the very beginning
 st.set_page_config(
     page_title="Story2Test AI",
@@ -65,8 +220,7 @@ st.set_page_config(
 )
 
 # Custom CSS
-st.markdown("""
-<style>
+CUSTOM_CSS = """
     .stApp header {visibility: hidden;}
     .main .block-container {padding-top: 2rem;}
     
@@ -93,8 +247,15 @@ st.markdown("""
     h3 {
         color: #555;
     }
-</style>
-""", unsafe_allow_html=True)
+"""
+
+@st.cache_data(show_spinner=False)
+def page_css() -> str:
+    # Collapsed to a single line once; reruns send the same short string
+    css = " ".join(line.strip() for line in CUSTOM_CSS.splitlines() if line.strip())
+    return f"<style>{css}</style>"
+
+st.markdown(page_css(), unsafe_allow_html=True)
 
 st.title("🧪 Story2Test AI")
 st.markdown("### Transform Acceptance Criteria into Comprehensive Test Scenarios")
@@ -109,6 +270,75 @@ with st.sidebar:
     
     st.markdown("---")
 
+@st.fragment
+def render_results():
+    # Reruns on its own for interactions inside the results pane (e.g. downloads)
+    results_df = st.session_state['last_results']
+    
+    tab1, tab2, tab3 = st.tabs(["📋 All Tests", "✅ Positive Scenarios", "❌ Negative Scenarios"])
+    
+    # Column configuration for professional table
+    column_config = {
+        "Priority": st.column_config.SelectboxColumn(
+            "Priority",
+            help="Test Case Priority",
+            width="small",
+            options=PRIORITIES,
+            required=True,
+        ),
+        "Type": st.column_config.TextColumn("Type", width="small"),
+        "Steps": st.column_config.TextColumn("Steps", width="large"),
+        "Title": st.column_config.TextColumn("Title", width="medium"),
+    }
+
+    with tab1:
+        st.dataframe(
+            results_df, 
+            use_container_width=True, 
+            column_config=column_config,
+            hide_index=True
+        )
+    
+    with tab2:
+        st.dataframe(
+            st.session_state['pos_df'],
+            use_container_width=True,
+            column_config=column_config,
+            hide_index=True
+        )
+        
+    with tab3:
+        st.dataframe(
+            st.session_state['neg_df'],
+            use_container_width=True,
+            column_config=column_config,
+            hide_index=True
+        )
+
+    st.markdown("---")
+    d_col1, d_col2 = st.columns(2)
+    
+    # Prepare downloads (cached on the DataFrame contents, so reruns don't rebuild them)
+    csv_bytes = build_csv(results_df)
+    xlsx_bytes = build_xlsx(results_df)
+    
+    with d_col1:
+        st.download_button(
+            "📄 Download CSV", 
+            csv_bytes, 
+            "story2test_cases.csv", 
+            "text/csv", 
+            use_container_width=True
+        )
+    with d_col2:
+        st.download_button(
+            "📊 Download Excel", 
+            xlsx_bytes, 
+            "story2test_cases.xlsx", 
+            "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", 
+            use_container_width=True
+        )
+
 col1, col2 = st.columns([1, 1], gap="large")
 
 with col1:
@@ -134,130 +364,59 @@ with col2:
             st.warning("⚠️ Please enter some acceptance criteria first.")
             st.stop()
             
-        with st.spinner("🤖 Analyzing requirements & generating logical test scenarios..."):
-            prompt = PROMPT.format(ac=ac)
-            try:
-                raw = call_openai(prompt)
-            except Exception as e:
-                st.error(f"Error: {e}")
-                st.stop()
-
-            parsed = extract_json(raw)
-
-            if "positive" not in parsed and "negative" not in parsed:
-                st.error("Could not parse JSON output. Please try again.")
-                with st.expander("View Raw Output"):
-                    st.text(raw)
-                st.stop()
-
-            pos = parsed.get("positive", [])
-            neg = parsed.get("negative", [])
-
-            # Helper to create DF
-            def to_df(items, kind):
-                rows = []
-                for t in items:
-                    rows.append({
-                        "Type": kind,  # Capitalized for display
-                        "ID": t.get("id", ""),
-                        "Title": t.get("title", ""),
-                        "Preconditions": t.get("preconditions", ""),
-                        "Steps": "\n".join(t.get("steps", [])),
-                        "Expected Result": t.get("expected_result", ""),
-                        "Priority": t.get("priority", "Medium") # Default to Medium
-                    })
-                return pd.DataFrame(rows)
-
-            df_pos = to_df(pos, "Positive")
-            df_neg = to_df(neg, "Negative")
+        # Same input as the results on screen: skip the API call entirely
+        ac_hash = hashlib.blake2b(ac.encode(), digest_size=16).hexdigest()
+        if st.session_state.get('ac_hash') == ac_hash and 'last_results' in st.session_state:
+            st.info("♻️ Reusing previous result for identical input.")
+        else:
+            with st.spinner("🤖 Analyzing requirements & generating logical test scenarios..."):
+                try:
+                    results, raw = call_openai_batch([ac])
+                except Exception as e:
+                    st.error(f"Error: {e}")
+                    st.stop()
+
+                parsed = results[0]
+
+                if "positive" not in parsed and "negative" not in parsed:
+                    st.error("Could not parse JSON output. Please try again.")
+                    with st.expander("View Raw Output"):
+                        st.text(raw)
+                    st.stop()
+
+                pos = parsed.get("positive", [])
+                neg = parsed.get("negative", [])
+
+                # Helper to create DF
+                def to_df(items, kind):
+                    # Normalise every field to text first; keys missing from the model output become empty columns
+                    items = [t for t in items if isinstance(t, dict)] if isinstance(items, list) else []
+                    df = pl.DataFrame(
+                        {col: [cell_text(t.get(key)) for t in items] for key, col in FIELD_COLUMNS.items()},
+                        schema=dict.fromkeys(FIELD_COLUMNS.values(), pl.String),
+                    )
+                    # Unknown priorities fall back to Medium so they stay within the selectbox options
+                    priority = pl.col("Priority").str.strip_chars().str.to_titlecase()
+                    return df.select(
+                        pl.lit(kind, dtype=pl.Enum(TEST_TYPES)).alias("Type"),  # Capitalized for display
+                        pl.col("ID", "Title", "Preconditions", "Steps", "Expected Result").fill_null(""),
+                        pl.when(priority.is_in(PRIORITIES)).then(priority).otherwise(pl.lit("Medium"))  # Default to Medium
+                        .cast(pl.Enum(PRIORITIES)).alias("Priority"),
+                    )
+
+                df_pos = to_df(pos, "Positive")
+                df_neg = to_df(neg, "Negative")
             
-            # Master DataFrame
-            df_all = pd.concat([df_pos, df_neg], ignore_index=True)
+                # Master DataFrame
+                df_all = pl.concat([df_pos, df_neg])
             
-            # Store in session state to persist after rerun (if we added other interactions)
-            st.session_state['last_results'] = df_all
-            st.success(f"✅ Generated {len(pos)} positive and {len(neg)} negative test cases!")
+                # Store in session state to persist after rerun (if we added other interactions)
+                st.session_state['last_results'] = df_all
+                st.session_state['pos_df'] = df_pos
+                st.session_state['neg_df'] = df_neg
+                st.session_state['ac_hash'] = ac_hash
+                st.success(f"✅ Generated {len(df_pos)} positive and {len(df_neg)} negative test cases!")
 
     # Display results if they exist
     if 'last_results' in st.session_state:
-        results_df = st.session_state['last_results']
-        
-        tab1, tab2, tab3 = st.tabs(["📋 All Tests", "✅ Positive Scenarios", "❌ Negative Scenarios"])
-        
-        # Column configuration for professional table
-        column_config = {
-            "Priority": st.column_config.SelectboxColumn(
-                "Priority",
-                help="Test Case Priority",
-                width="small",
-                options=["High", "Medium", "Low"],
-                required=True,
-            ),
-            "Type": st.column_config.TextColumn("Type", width="small"),
-            "Steps": st.column_config.TextColumn("Steps", width="large"),
-            "Title": st.column_config.TextColumn("Title", width="medium"),
-        }
-
-        def style_priority(val):
-            color = 'white'
-            if val == 'High': color = '#ffcccb' # Light red
-            elif val == 'Medium': color = '#ffe5cc' # Light orange
-            elif val == 'Low': color = '#ccffcc' # Light green
-            return f'background-color: {color}; color: black; border-radius: 4px; padding: 2px;'
-
-        with tab1:
-            st.dataframe(
-                results_df, 
-                use_container_width=True, 
-                column_config=column_config,
-                hide_index=True
-            )
-        
-        with tab2:
-            st.dataframe(
-                results_df[results_df["Type"] == "Positive"],
-                use_container_width=True,
-                column_config=column_config,
-                hide_index=True
-            )
-            
-        with tab3:
-            st.dataframe(
-                results_df[results_df["Type"] == "Negative"],
-                use_container_width=True,
-                column_config=column_config,
-                hide_index=True
-            )
-
-        st.markdown("---")
-        d_col1, d_col2 = st.columns(2)
-        
-        # Prepare downloads
-        csv = results_df.to_csv(index=False).encode("utf-8")
-        
-        excel_buf = io.BytesIO()
-        with pd.ExcelWriter(excel_buf, engine="xlsxwriter") as w:
-            results_df.to_excel(w, index=False, sheet_name="TestCases")
-            # Auto-adjust columns width
-            worksheet = w.sheets['TestCases']
-            for i, col in enumerate(results_df.columns):
-                column_len = max(results_df[col].astype(str).map(len).max(), len(col)) + 2
-                worksheet.set_column(i, i, column_len)
-        excel_buf.seek(0)
-        
-        with d_col1:
-            st.download_button(
-                "📄 Download CSV", 
-                csv, 
-                "story2test_cases.csv", 
-                "text/csv", 
-                use_container_width=True
-            )
-        with d_col2:
-            st.download_button(
-                "📊 Download Excel", 
-                excel_buf, 
-                "story2test_cases.xlsx", 
-                "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", 
-                use_container_width=True
-            )
+        render_results()